@@ -1,37 +1,73 @@
 import streamlit as st
-import tiktoken  # Import tiktoken
+import hashlib  # For detecting unchanged uploads across reruns
+import io  # For in-memory file handling
 import os
-import tempfile  # For temporary file handling
+from concurrent.futures import ThreadPoolExecutor  # For concurrent extraction and LLM calls
+from typing import Optional
 
 from dotenv import load_dotenv
 from chains.rag import ContractRAGChain  # Import the RAG chain class
 from chains.analysis import ContractAnalysisChain  # Import the analysis chain class
 from utils.file_handler import extract_text  # Text extraction utility
 from utils.vector_store import create_vector_store  # Vector store utility
+from utils.tokens import get_encoder  # Shared tiktoken encoder
 from langchain_core.documents import Document # For creating Document objects
 
 # Load environment variables
 load_dotenv()
 
+# Upper bound on concurrent analysis requests sent to the LLM provider
+MAX_ANALYSIS_WORKERS = 8
+# Upper bound on files extracted concurrently
+MAX_EXTRACTION_WORKERS = 4
+
 # Constants for token management
 MAX_TOKENS = 8192
 WARN_THRESHOLD = 5734  # 70% of max
 BUFFER_TOKENS = 500
 
 # Token counting function
-encoder = tiktoken.encoding_for_model('gpt-4')  # Adjust model if needed
+# get_encoder is cached at module level, so Streamlit reruns reuse a single instance
+encoder = get_encoder()
 
 def count_tokens(messages):
-    total_tokens = 0
-    for msg in messages:
-        total_tokens += len(encoder.encode(msg['content']))
-    return total_tokens
+    # Per-message counts are kept in session state (keyed by id(msg)) so that
+    # history messages are not re-encoded on every chat turn
+    cached_counts = st.session_state.get('token_counts', {})
+    pending = [msg for msg in messages if cached_counts.get(id(msg), (None, 0))[0] != msg['content']]
+    if pending:
+        encoded = encoder.encode_batch([msg['content'] for msg in pending], num_threads=os.cpu_count() or 1)
+        for msg, tokens in zip(pending, encoded):
+            cached_counts[id(msg)] = (msg['content'], len(tokens))
+
+    # Drop entries for messages that are no longer part of the conversation
+    st.session_state['token_counts'] = {id(msg): cached_counts[id(msg)] for msg in messages}
+    return sum(count for _, count in st.session_state['token_counts'].values())
+
+# Helper function to extract one uploaded file into a Document
+# Runs in worker threads, so it must not call Streamlit; returns None on failure
+def _process_upload(uploaded_file) -> Optional[Document]:
+    # Get the file extension from the uploaded file name
+    file_extension = uploaded_file.name.split('.')[-1].lower()
+
+    # Extract text straight from the uploaded bytes, no temporary file needed
+    stream = io.BytesIO(uploaded_file.getvalue())
+    stream.name = uploaded_file.name
+    extracted_text = extract_text(stream, suffix=file_extension)
+
+    if not extracted_text:
+        return None
+    return Document(page_content=extracted_text, metadata={"source": uploaded_file.name})
 
 # Helper function to get the RAG chain instance
-def get_rag_chain(vector_store):
-    return ContractRAGChain(vector_store)
+# Cached per vector store: the leading underscore stops Streamlit from hashing the
+# store itself, so its id() is passed separately as the cache key
+@st.cache_resource(max_entries=4)
+def get_rag_chain(vector_store_id, _vector_store):
+    return ContractRAGChain(_vector_store)
 
 # Helper function to get the analysis chain instance
+@st.cache_resource
 def get_analysis_chain():
     return ContractAnalysisChain()
 
@@ -47,49 +83,65 @@ chunk_overlap = st.sidebar.slider("Chunk Overlap (characters)", min_value=50, ma
 uploaded_files = st.file_uploader("Upload PDF or DOCX contracts", accept_multiple_files=True, type=["pdf", "docx"])
 
 if uploaded_files:
+    # Streamlit reruns this block on every interaction (including each chat turn);
+    # only re-extract when the set of uploads changes
+    upload_key = tuple((uploaded_file.name, uploaded_file.file_id) for uploaded_file in uploaded_files)
+    if st.session_state.get('upload_key') != upload_key:
+        # Extract text from all uploaded files concurrently (DOCX parsing overlaps;
+        # PDF extraction is serialized inside file_handler because PDFium is not thread-safe)
+        with ThreadPoolExecutor(max_workers=min(MAX_EXTRACTION_WORKERS, len(uploaded_files))) as executor:
+            st.session_state['extracted_docs'] = list(executor.map(_process_upload, uploaded_files))
+        st.session_state['upload_key'] = upload_key
+    extracted_docs = st.session_state['extracted_docs']
+
     all_docs = []
-    for uploaded_file in uploaded_files:
-        # Get the file extension from the uploaded file name
-        file_extension = uploaded_file.name.split('.')[-1].lower()
-        
-        # Save uploaded file to a temporary location with proper extension
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_extension}') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_path = tmp_file.name
-        
-        # Extract text
-        extracted_text = extract_text(tmp_path)
-        if extracted_text:
-            doc = Document(page_content=extracted_text, metadata={"source": uploaded_file.name})
+    for uploaded_file, doc in zip(uploaded_files, extracted_docs):
+        if doc is not None:
             all_docs.append(doc)
         else:
             st.warning(f"Failed to extract text from {uploaded_file.name}. Skipping.")
-        
-        # Clean up temporary file
-        os.unlink(tmp_path)
     
     if all_docs:
-        with st.spinner("Processing documents and creating embeddings..."):
-            # Create vector store with chunking parameters
-            vector_store = create_vector_store(
-                all_docs, 
-                chunk_size=chunk_size, 
-                chunk_overlap=chunk_overlap
-            )
-            st.session_state['vector_store'] = vector_store
+        # Streamlit reruns this block on every interaction; identify the upload by name and content
+        docs_key = tuple(
+            (doc.metadata["source"], hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest())
+            for doc in all_docs
+        )
+        vector_store_key = (docs_key, chunk_size, chunk_overlap)
+        
+        if st.session_state.get('vector_store_key') != vector_store_key:
+            with st.spinner("Processing documents and creating embeddings..."):
+                # Create vector store with chunking parameters, reusing this session's
+                # per-document embeddings for documents whose chunking is unchanged
+                # (emb_cache is pruned to the current documents, so it does not grow per upload)
+                vector_store = create_vector_store(
+                    all_docs, 
+                    chunk_size=chunk_size, 
+                    chunk_overlap=chunk_overlap,
+                    shard_cache=st.session_state.setdefault('emb_cache', {})
+                )
+                st.session_state['vector_store'] = vector_store
+                st.session_state['vector_store_key'] = vector_store_key
+        vector_store = st.session_state['vector_store']
         
         # Display chunking information
         total_chunks = vector_store.index.ntotal
         st.info(f"📄 Processed {len(all_docs)} documents into {total_chunks} chunks (Size: {chunk_size}, Overlap: {chunk_overlap})")
         
-        with st.spinner("Analyzing contracts..."):
-            # Analyze contracts (still use original documents for full analysis)
-            analysis_chain = get_analysis_chain()
-            analysis_results = []
-            for doc in all_docs:
-                result = analysis_chain.analyze_contract(doc.page_content)
-                analysis_results.append({"source": doc.metadata["source"], "result": result})
-            st.session_state['analysis_results'] = analysis_results
+        # Analysis depends only on the documents, so chunking changes do not re-run it
+        if st.session_state.get('analysis_key') != docs_key:
+            with st.spinner("Analyzing contracts..."):
+                # Analyze contracts (still use original documents for full analysis)
+                # Each call is an independent, I/O-bound LLM request, so run them concurrently
+                analysis_chain = get_analysis_chain()
+                with ThreadPoolExecutor(max_workers=min(MAX_ANALYSIS_WORKERS, len(all_docs))) as executor:
+                    results = executor.map(analysis_chain.analyze_contract, [doc.page_content for doc in all_docs])
+                    analysis_results = [
+                        {"source": doc.metadata["source"], "result": result}
+                        for doc, result in zip(all_docs, results)
+                    ]
+                st.session_state['analysis_results'] = analysis_results
+                st.session_state['analysis_key'] = docs_key
         
         st.success("Contracts processed and analyzed successfully!")
     else:
@@ -131,7 +183,8 @@ if 'vector_store' in st.session_state:
     # User input
     if prompt := st.chat_input("Ask a question about the contracts:"):
         # Calculate tokens
-        new_messages = st.session_state.messages + [{"role": "user", "content": prompt}]
+        user_message = {"role": "user", "content": prompt}
+        new_messages = st.session_state.messages + [user_message]
         total_used_tokens = count_tokens(new_messages) + BUFFER_TOKENS
 
         if total_used_tokens > MAX_TOKENS:
@@ -141,19 +194,18 @@ if 'vector_store' in st.session_state:
                 st.warning(f"High token usage ({total_used_tokens}/{MAX_TOKENS}). Consider summarizing or starting a new chat.")
 
             # Add user message
-            st.session_state.messages.append({"role": "user", "content": prompt})
+            st.session_state.messages.append(user_message)
             with st.chat_message("user"):
                 st.markdown(prompt)
 
-            # Get response
-            with st.spinner("Searching through contract chunks..."):
-                rag_chain = get_rag_chain(st.session_state['vector_store'])
-                response = rag_chain.invoke(prompt)
+            # Get response, streamed so the answer renders as it is generated
+            vector_store = st.session_state['vector_store']
+            rag_chain = get_rag_chain(id(vector_store), vector_store)
+            with st.chat_message("assistant"):
+                response = st.write_stream(rag_chain.stream(prompt))
 
             # Add assistant message
             st.session_state.messages.append({"role": "assistant", "content": response})
-            with st.chat_message("assistant"):
-                st.markdown(response)
 
     # Context management buttons
     col1, col2 = st.columns(2)
@@ -163,6 +215,7 @@ if 'vector_store' in st.session_state:
     with col2:
         if st.button("Start New Chat"):
             st.session_state.messages = []
+            st.session_state['token_counts'] = {}
             st.rerun()  # Updated from experimental_rerun
 else:
     st.info("Upload and analyze contracts first.")
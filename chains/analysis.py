@@ -1,5 +1,9 @@
 import json
 import os
+import re
+import numpy as np
+import orjson
+from json_repair import repair_json
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
 from langchain_core.prompts import PromptTemplate
@@ -7,6 +11,38 @@ from prompts.templates import ANALYSIS_PROMPT
 
 load_dotenv()
 
+# Define Clause Weights for Weighted Average Calculation
+CLAUSE_WEIGHTS = {
+    "liability": 3.0,
+    "indemnity": 3.0,
+    "intellectual property": 3.0,
+    "termination": 2.5,
+    "fees and payment terms": 2.5,
+    "scope of services": 2.0,
+    "confidentiality": 1.5,
+    "amendments": 1.0,
+    "force majeure": 1.0,
+    "default": 1.5,
+}
+
+# Weight keys pre-split into word sets, longest first so the most specific key wins
+# (sorted() is stable, so equal-length keys keep their CLAUSE_WEIGHTS order)
+_KEY_WORDS = sorted(
+    ((frozenset(key.split()), weight) for key, weight in CLAUSE_WEIGHTS.items() if key != "default"),
+    key=lambda item: -len(item[0])
+)
+_WORD_RE = re.compile(r"\w+")
+
+
+def _clause_weight(name: str) -> float:
+    """Return the weight of the longest key whose words all appear in a lowercased clause name."""
+    words = set(_WORD_RE.findall(name))
+    for key_words, weight in _KEY_WORDS:
+        if key_words <= words:
+            return weight
+    return CLAUSE_WEIGHTS["default"]
+
+
 class ContractAnalysisChain:
     def __init__(self):
         self.llm = ChatGroq(
@@ -36,14 +72,15 @@ class ContractAnalysisChain:
             response_text = response.content.strip()
             
             # Llama sometimes wraps JSON in markdown code blocks
+            # (truncated output may be missing the closing fence)
             if "```json" in response_text:
                 start = response_text.find("```json") + 7
-                end = response_text.rfind("```")
-                response_text = response_text[start:end].strip()
+                end = response_text.rfind("```", start)
+                response_text = response_text[start:end if end != -1 else None].strip()
             elif "```" in response_text:
                 start = response_text.find("```") + 3
-                end = response_text.rfind("```")
-                response_text = response_text[start:end].strip()
+                end = response_text.rfind("```", start)
+                response_text = response_text[start:end if end != -1 else None].strip()
             
             # Handle empty responses
             if not response_text or response_text == "":
@@ -54,53 +91,30 @@ class ContractAnalysisChain:
                     "overall_risk_score": None
                 }
             
-            # Fix truncated JSON
-            if not response_text.endswith('}'):
-                last_complete_clause = response_text.rfind('    }')
-                if last_complete_clause != -1:
-                    clauses_end = response_text.rfind('  ]', last_complete_clause)
-                    if clauses_end != -1:
-                        response_text = response_text[:clauses_end + 3] + ',\n  "flags": [],\n  "overall_risk_score": null\n}'
+            # Parse the JSON response, repairing truncated or malformed output if needed
+            # (orjson.JSONDecodeError subclasses json.JSONDecodeError)
+            try:
+                result = orjson.loads(response_text)
+            except orjson.JSONDecodeError:
+                result = orjson.loads(repair_json(response_text))
+            if not isinstance(result, dict):
+                raise json.JSONDecodeError("Expected a JSON object", response_text, 0)
             
-            # Parse the JSON response
-            result = json.loads(response_text)
-            
-            # Define Clause Weights for Weighted Average Calculation
-            CLAUSE_WEIGHTS = {
-                "liability": 3.0,
-                "indemnity": 3.0,
-                "intellectual property": 3.0,
-                "termination": 2.5,
-                "fees and payment terms": 2.5,
-                "scope of services": 2.0,
-                "confidentiality": 1.5,
-                "amendments": 1.0,
-                "force majeure": 1.0,
-                "default": 1.5,
-            }
-
             # Calculate overall risk score as weighted average
+            # Non-numeric or non-positive scores are masked out of the average
             clauses = result.get("clauses", [])
-            total_weighted_score = 0.0
-            total_weight = 0.0
-            
+            score_list = []
+            weight_list = []
             for clause in clauses:
                 score = clause.get("risk_score", 0)
-                name = clause.get("clause_name", "").lower()
-                weight = CLAUSE_WEIGHTS["default"]
-                
-                # Find matching weight
-                for key, w in CLAUSE_WEIGHTS.items():
-                    if key != "default" and key in name:
-                        weight = w
-                        break
-                
-                if isinstance(score, (int, float)) and score > 0:
-                    total_weighted_score += (score * weight)
-                    total_weight += weight
+                score_list.append(score if isinstance(score, (int, float)) else 0)
+                weight_list.append(_clause_weight(clause.get("clause_name", "").lower()))
 
-            if total_weight > 0:
-                result["overall_risk_score"] = round(total_weighted_score / total_weight, 1)
+            scores = np.asarray(score_list, dtype=np.float64)
+            weights = np.asarray(weight_list, dtype=np.float64)
+            mask = scores > 0
+            if mask.any():
+                result["overall_risk_score"] = round(float(np.average(scores[mask], weights=weights[mask])), 1)
             else:
                 result["overall_risk_score"] = None
             
@@ -1,12 +1,71 @@
 import os
 import json
+import hashlib
+import pickle
+import tempfile
+import functools
 from dotenv import load_dotenv
 import logging
 
+import faiss
+import numpy as np
 from langchain_groq import ChatGroq
 
+from utils.tokens import truncate_to_tokens
+from utils.vector_store import embedding_cache_key
+
 load_dotenv()
 
+# Semantic cache configuration
+# Answers are reused when a new question's embedding has cosine similarity above the threshold
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", ".cache/semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_ENTRIES = 1000
+
+# Retrieval: MMR diversity re-ranking over a larger candidate pool, then drop weak matches
+# The vector store uses inner product on normalized embeddings, so scores are cosine
+# similarities (higher is better); the best match is always kept
+RETRIEVAL_SEARCH_KWARGS = {"k": 6, "fetch_k": 24, "lambda_mult": 0.5}
+MIN_RELEVANCE_SCORE = 0.3
+
+# Context budget: drop near-duplicate chunks (word-set Jaccard at or above the
+# threshold) and cap the joined context at a fixed number of tokens
+DEDUP_JACCARD_THRESHOLD = 0.7
+MAX_CONTEXT_TOKENS = 3000
+
+# Exact-match caches for repeated questions (question embedding and retrieved context), per chain
+RETRIEVAL_CACHE_SIZE = 128
+
+
+# Helper method to fingerprint a vector store's contents and the models behind the cache
+# Cached answers are only valid for the contracts, embedding space and LLM they were generated with
+
+def _vector_store_fingerprint(vector_store):
+    digest = hashlib.sha256()
+    digest.update(embedding_cache_key(vector_store.embedding_function).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update((os.getenv("GROQ_MODEL") or "").encode("utf-8"))
+    digest.update(b"\0")
+    for doc_id in vector_store.index_to_docstore_id.values():
+        digest.update(vector_store.docstore.search(doc_id).page_content.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+# Helper method to drop retrieved chunks that mostly repeat an earlier, higher-ranked one
+
+def _dedupe_docs(docs, threshold=DEDUP_JACCARD_THRESHOLD):
+    kept = []
+    kept_words = []
+    for doc in docs:
+        words = set(doc.page_content.lower().split())
+        if any(len(words & other) / (len(words | other) or 1) >= threshold for other in kept_words):
+            continue
+        kept.append(doc)
+        kept_words.append(words)
+    return kept
+
+
 class ContractRAGChain:
     def __init__(self, vector_store):
         """Initialize RAG Chain with vector store and Groq LLM"""
@@ -18,21 +77,155 @@ class ContractRAGChain:
                 api_key=os.getenv("GROQ_API_KEY")
             )
             self.vector_store = vector_store
-            self.retriever = vector_store.as_retriever()
+
+            # Semantic cache of past (question embedding -> answer) pairs, in LRU order
+            self._cache_dir = os.path.join(SEMANTIC_CACHE_DIR, _vector_store_fingerprint(vector_store))
+            self._cache_index = None
+            self._cache_store: list[tuple[str, str]] = []
+            self._load_cache()
+
+            # Per-instance caches so repeated questions skip embedding and retrieval
+            self._question_embedding = functools.lru_cache(maxsize=RETRIEVAL_CACHE_SIZE)(self._embed_question)
+            self._retrieve_context = functools.lru_cache(maxsize=RETRIEVAL_CACHE_SIZE)(self._build_context)
         except Exception as e:
             logging.error(f"Error initializing ContractRAGChain: {e}")
             raise e
 
+    def _embed_question(self, question):
+        """Return the normalized question embedding as a (1, dim) float32 array"""
+        q_emb = np.array([self.vector_store.embedding_function.embed_query(question)], dtype="float32")
+        faiss.normalize_L2(q_emb)
+        return q_emb
+
+    def _load_cache(self):
+        """Restore the semantic cache for this vector store from disk, if present"""
+        cache_path = os.path.join(self._cache_dir, "cache.pkl")
+        if not os.path.exists(cache_path):
+            return
+        try:
+            with open(cache_path, "rb") as fh:
+                payload = pickle.load(fh)
+            embeddings = np.asarray(payload["embeddings"], dtype="float32")
+            cache_store = payload["store"]
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable semantic cache at {self._cache_dir}: {e}")
+            return
+
+        # A cache built with another embedding dimension (or out of sync) is treated as a miss
+        if embeddings.ndim != 2 or embeddings.shape != (len(cache_store), self.vector_store.index.d):
+            logging.warning(f"Ignoring incompatible semantic cache at {self._cache_dir}")
+            return
+        self._cache_index = faiss.IndexFlatIP(embeddings.shape[1])
+        self._cache_index.add(embeddings)
+        self._cache_store = cache_store
+
+    def _save_cache(self):
+        """Persist the semantic cache; failures only cost future cache hits
+
+        Embeddings and answers go into a single file that is swapped in with os.replace,
+        so chains sharing this cache directory never load one without the other.
+        """
+        tmp_path = None
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            payload = {
+                "embeddings": self._cache_index.reconstruct_n(0, self._cache_index.ntotal),
+                "store": self._cache_store,
+            }
+            with tempfile.NamedTemporaryFile("wb", dir=self._cache_dir, suffix=".tmp", delete=False) as fh:
+                tmp_path = fh.name
+                pickle.dump(payload, fh)
+            os.replace(tmp_path, os.path.join(self._cache_dir, "cache.pkl"))
+        except Exception as e:
+            logging.warning(f"Could not persist semantic cache to {self._cache_dir}: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _cache_lookup(self, q_emb):
+        """Return a cached answer for a near-identical question, or None"""
+        if self._cache_index is None or self._cache_index.ntotal == 0:
+            return None
+        scores, ids = self._cache_index.search(q_emb, 1)
+        if scores[0, 0] <= SEMANTIC_CACHE_THRESHOLD:
+            return None
+
+        # Move the hit to the most-recently-used end (in memory only; the order is
+        # persisted with the next _cache_put, keeping hits off the disk)
+        pos = int(ids[0, 0])
+        vector = self._cache_index.reconstruct(pos).reshape(1, -1)
+        self._cache_index.remove_ids(np.array([pos], dtype="int64"))
+        self._cache_index.add(vector)
+        self._cache_store.append(self._cache_store.pop(pos))
+        return self._cache_store[-1][1]
+
+    def _cache_put(self, question, answer, q_emb):
+        """Add an answer to the semantic cache, evicting least-recently-used entries"""
+        if self._cache_index is None:
+            self._cache_index = faiss.IndexFlatIP(q_emb.shape[1])
+        self._cache_index.add(q_emb)
+        self._cache_store.append((question, answer))
+
+        overflow = self._cache_index.ntotal - SEMANTIC_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            self._cache_index.remove_ids(np.arange(overflow, dtype="int64"))
+            del self._cache_store[:overflow]
+        self._save_cache()
+
+    def _retrieve(self, q_emb):
+        """Return MMR-ranked documents for a question embedding, minus low-similarity matches"""
+        docs_and_scores = self.vector_store.max_marginal_relevance_search_with_score_by_vector(
+            q_emb[0].tolist(), **RETRIEVAL_SEARCH_KWARGS
+        )
+        return [
+            doc for i, (doc, score) in enumerate(docs_and_scores)
+            if i == 0 or score >= MIN_RELEVANCE_SCORE
+        ]
+
+    def _build_context(self, question):
+        """Return deduplicated, token-capped contract context for the question"""
+        docs = _dedupe_docs(self._retrieve(self._question_embedding(question)))
+        return truncate_to_tokens("\n".join([doc.page_content for doc in docs]), MAX_CONTEXT_TOKENS)
+
+    def _build_prompt(self, question):
+        """Retrieve contract context for the question and format the LLM prompt"""
+        context = self._retrieve_context(question)
+        
+        return f"Based on this contract:\n{context}\n\nQuestion: {question}\n\nAnswer:"
+
     def invoke(self, question):
-        """Use retriever + LLM to answer questions based on contract context"""
+        """Use MMR retrieval + LLM to answer questions based on contract context"""
         try:
-            docs = self.retriever.invoke(question)
-            context = "\n".join([doc.page_content for doc in docs])
-            
-            prompt = f"Based on this contract:\n{context}\n\nQuestion: {question}\n\nAnswer:"
+            q_emb = self._question_embedding(question)
+            cached_answer = self._cache_lookup(q_emb)
+            if cached_answer is not None:
+                return cached_answer
+
+            prompt = self._build_prompt(question)
             response = self.llm.invoke(prompt)
             
+            self._cache_put(question, response.content, q_emb)
             return response.content
         except Exception as e:
             logging.error(f"Error during RAG chain invocation: {e}")
             raise e
+
+    def stream(self, question):
+        """Like invoke, but yield the answer in chunks as the LLM generates it"""
+        try:
+            q_emb = self._question_embedding(question)
+            cached_answer = self._cache_lookup(q_emb)
+            if cached_answer is not None:
+                yield cached_answer
+                return
+
+            prompt = self._build_prompt(question)
+            parts = []
+            for chunk in self.llm.stream(prompt):
+                parts.append(chunk.content)
+                yield chunk.content
+
+            # Only cache answers that streamed to completion
+            self._cache_put(question, "".join(parts), q_emb)
+        except Exception as e:
+            logging.error(f"Error during RAG chain streaming: {e}")
+            raise e
@@ -3,77 +3,106 @@
 # ----------------------------------------------------
 
 import logging
+import threading
 from pathlib import Path
+from typing import BinaryIO, Optional, Union
 
 # Explicitly import errors for specific handling
-import PyPDF2
-from PyPDF2.errors import PdfReadError 
+import pypdfium2 as pdfium
+from pypdfium2 import PdfiumError
 import docx
 
 logging.basicConfig(level=logging.INFO)
 
+# A file path, or a binary stream such as an in-memory upload
+Source = Union[str, Path, BinaryIO]
+
+# PDFium is not thread-safe: no two PDFium calls may run concurrently, even on
+# different documents, so callers extracting files from worker threads are serialized here
+_PDFIUM_LOCK = threading.Lock()
+
 # ---------- internal helpers -------------------------------------------------
-def _extract_pdf(path: Path) -> str:
-    """Return concatenated text from every page in a PDF."""
+def _extract_pdf(src: Source, name: str) -> str:
+    """Return concatenated text from every page in a PDF path or stream."""
     text = ""
     try:
-        with path.open("rb") as fh:
-            reader = PyPDF2.PdfReader(fh)
-            for page in reader.pages:
-                page_txt = page.extract_text()
-                # Use a cleaner way to concatenate non-empty text
-                if page_txt and page_txt.strip():
-                    text += page_txt.strip() + "\n"
-    except PdfReadError:
-        logging.error(f"PDF extraction failed - File is corrupted or encrypted: {path.name}")
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(src)
+            try:
+                # Collect page texts and join once instead of repeated string concatenation
+                parts: list[str] = []
+                for i in range(len(pdf)):
+                    page = pdf[i]
+                    textpage = page.get_textpage()
+                    page_txt = (textpage.get_text_range() or "").strip()
+                    if page_txt:
+                        parts.append(page_txt)
+                    textpage.close()
+                    page.close()
+                text = "\n".join(parts)
+            finally:
+                pdf.close()
+    except PdfiumError:
+        logging.error(f"PDF extraction failed - File is corrupted or encrypted: {name}")
     except Exception as err:
-        logging.error(f"PDF extraction failed - {path.name}: {err}")
+        logging.error(f"PDF extraction failed - {name}: {err}")
     return text
 
 
-def _extract_docx(path: Path) -> str:
-    """Return concatenated paragraph text from a DOCX."""
+def _extract_docx(src: Source, name: str) -> str:
+    """Return concatenated paragraph text from a DOCX path or stream."""
     text = ""
     try:
-        doc = docx.Document(path)
+        doc = docx.Document(src)
         # Cleaner list comprehension for concatenation
         text = "\n".join(p.text for p in doc.paragraphs if p.text.strip())
     except Exception as err:
-        logging.error(f"DOCX extraction failed – {path.name}: {err}")
+        logging.error(f"DOCX extraction failed – {name}: {err}")
     return text
 
 
 # ---------- public API --------------------------------------------------------
-def extract_text(file_path: str) -> str:
+def extract_text(src: Source, suffix: Optional[str] = None) -> str:
     """
     Extract raw text from a PDF or DOCX. 
     Unsupported types return an empty string.
 
     Parameters
     ----------
-    file_path : str
-        Absolute or relative path to the contract file.
+    src : str, Path or binary file-like
+        Path to the contract file, or an open binary stream (e.g. an
+        in-memory upload) which is read without touching disk.
+    suffix : str, optional
+        File type such as "pdf" or ".docx". Defaults to the path's suffix,
+        or the stream's ``name`` attribute when reading from a stream.
 
     Returns
     -------
     str
         Extracted UTF-8 text (may be empty if parsing fails).
     """
-    path = Path(file_path)
-    
-    # Improvement: Check if file exists first
-    if not path.is_file():
-        logging.error(f"File not found: {file_path}")
-        return ""
-
-    suffix = path.suffix.lower()
+    if isinstance(src, (str, Path)):
+        path = Path(src)
+
+        # Improvement: Check if file exists first
+        if not path.is_file():
+            logging.error(f"File not found: {src}")
+            return ""
+        name = path.name
+        src = str(path)
+    else:
+        name = getattr(src, "name", None) or "<stream>"
+
+    if suffix is None:
+        suffix = Path(name).suffix
+    suffix = "." + suffix.lower().lstrip(".")
 
     if suffix == ".pdf":
-        return _extract_pdf(path)
+        return _extract_pdf(src, name)
     if suffix == ".docx":
-        return _extract_docx(path)
+        return _extract_docx(src, name)
 
-    logging.error(f"Unsupported file type: {path.name}")
+    logging.error(f"Unsupported file type: {name}")
     return ""
 
 
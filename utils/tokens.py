@@ -0,0 +1,22 @@
+# utils/tokens.py
+# Shared tiktoken encoder and token-budget helpers
+# ----------------------------------------------------
+
+import functools
+
+import tiktoken
+
+
+@functools.lru_cache(maxsize=1)
+def get_encoder():
+    """Return the process-wide tiktoken encoder (created on first use)."""
+    return tiktoken.encoding_for_model('gpt-4')  # Adjust model if needed
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Return text cut down to at most max_tokens tokens."""
+    encoder = get_encoder()
+    tokens = encoder.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoder.decode(tokens[:max_tokens])